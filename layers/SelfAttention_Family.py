@@ -2,6 +2,7 @@ import math
 from typing import Tuple
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import numpy as np
 from math import sqrt
 from utils.masking import TriangularCausalMask, ProbMask
@@ -147,6 +148,16 @@ class FullAttention(nn.Module):
         _, S, _, D = values.shape
         scale = self.scale or 1. / sqrt(E)
 
+        # fused SDPA kernel unless the weights are requested or a mask is given, so scores are never materialized
+        if not self.output_attention and attn_mask is None:
+            # [B, L, H, E] -> [B, H, L, E]
+            V = F.scaled_dot_product_attention(
+                queries.transpose(1, 2), keys.transpose(1, 2), values.transpose(1, 2),
+                dropout_p=self.dropout.p if self.training else 0.,
+                is_causal=self.mask_flag, scale=scale
+            )
+            return V.transpose(1, 2).contiguous(), None
+
         scores = torch.einsum("blhe,bshe->bhls", queries, keys)
 
         if self.mask_flag:
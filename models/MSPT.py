@@ -7,136 +7,173 @@ from layers.Embed import DataEmbedding, DataEmbedding_inverted, PositionalEmbedd
 from layers.Transformer_EncDec import Encoder, EncoderLayer
 from layers.SelfAttention_Family import FullAttention
 
-import numpy as np
 from math import sqrt, ceil
-from einops import rearrange, repeat
-
-
-def dispatch(inp, gates):
-    # sort experts
-    _, index_sorted_experts = torch.nonzero(gates).sort(0)
-    # get according batch index for each expert
-    _batch_index = torch.nonzero(gates)[index_sorted_experts[:, 1], 0]
-    _part_sizes = (gates > 0).sum(0).tolist()
-    # assigns samples to experts whose gate is nonzero
-    # expand according to batch index so we can just split by _part_sizes
-    inp_exp = inp[_batch_index].squeeze(1)
-    return torch.split(inp_exp, _part_sizes, dim=0)
-
-def combine(expert_out, gates, multiply_by_gates=True):
-    # sort experts
-    sorted_experts, index_sorted_experts = torch.nonzero(gates).sort(0)
-    _, _expert_index = sorted_experts.split(1, dim=1)
-    # get according batch index for each expert
-    _batch_index = torch.nonzero(gates)[index_sorted_experts[:, 1], 0]
-    gates_exp = gates[_batch_index.flatten()]
-    _nonzero_gates = torch.gather(gates_exp, 1, _expert_index)
-    # apply exp to expert outputs, so we are not longer in log space
-    stitched = torch.cat(expert_out, 0).exp()
-    if multiply_by_gates:
-        stitched = torch.einsum("bcld,bc -> bcld", stitched, _nonzero_gates)
-    zeros = torch.zeros(gates.size(0), expert_out[-1].size(1), expert_out[-1].size(2), expert_out[-1].size(3),
-                        requires_grad=True, device=stitched.device)
-    # combine samples that have been processed by the same k experts
-    combined = zeros.index_add(0, _batch_index, stitched.float())
-    # add eps to all zero values in order to avoid nans when going back to log space
-    combined[combined == 0] = np.finfo(float).eps
-    # back to log space
-    return combined.log()
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def get_patch_sizes(seq_len):
+    # get the period list, first element is inf if exclude_zero is False
+    # kept in float32 on purpose: rounding makes floor(1 / rfftfreq) differ from seq_len // k for some seq_len
+    peroid_list = 1 / torch.fft.rfftfreq(seq_len)[1:]
+    # plain python ints, so iterating them in forward never touches a tensor
+    # return tuple(peroid_list.ceil().int().unique().flip(0).tolist())
+    return tuple(peroid_list.floor().int().unique().flip(0).tolist())
+
+class SparseDispatcher(object):
+    # routes each sample to the top_k patch sizes picked by the gating and merges their outputs back
+    def __init__(self, num_experts, gates, top_indices):
+        # gates [B, Ps], top_indices [B, top_k]
+        top_k = top_indices.size(1)
+        self._gates = gates
+        # sort the (sample, expert) pairs by expert, keeping samples in order within each expert
+        sorted_experts, index_sorted_experts = top_indices.flatten().sort(stable=True)
+        # get according batch index and gate for each expert
+        self._batch_index = index_sorted_experts.div(top_k, rounding_mode='floor')
+        self._nonzero_gates = gates.gather(1, top_indices).flatten()[index_sorted_experts]
+        # inverse of the sort, takes the expert-sorted rows back to [B, top_k] order
+        self._inverse_index = index_sorted_experts.argsort()
+        # the only host sync, torch.split needs python ints
+        self._part_sizes = torch.bincount(sorted_experts, minlength=num_experts).tolist()
+
+    def dispatch(self, inp):
+        # assigns each sample to its top_k experts
+        # expand according to batch index so we can just split by _part_sizes
+        inp_exp = inp[self._batch_index]
+        return torch.split(inp_exp, self._part_sizes, dim=0)
+
+    def combine(self, expert_out, multiply_by_gates=True):
+        # stay in log space: log(sum_k g_k * exp(x_k)) = logsumexp_k(x_k + log(g_k))
+        stitched = torch.cat(expert_out, 0).float()
+        if multiply_by_gates:
+            # a top-k softmax weight can underflow to 0, clamp so log (and its gradient) stays finite
+            stitched = stitched + self._nonzero_gates.clamp_min(torch.finfo(torch.float32).tiny).log().view(-1, 1, 1, 1)
+        # every sample has exactly top_k rows, so regroup them per sample and reduce over k
+        stitched = stitched[self._inverse_index].view(self._gates.size(0), -1, *stitched.shape[1:]) # [B, top_k, C, 1, D]
+        return torch.logsumexp(stitched, dim=1)
+
+def fuse_qkv_state_dict(state_dict, prefix):
+    # merge checkpoints saved with separate query/key/value projections into qkv_projection
+    for name in ('weight', 'bias'):
+        keys = [prefix + proj + '_projection.' + name for proj in ('query', 'key', 'value')]
+        if all(key in state_dict for key in keys):
+            state_dict[prefix + 'qkv_projection.' + name] = torch.cat([state_dict.pop(key) for key in keys], dim=0)
+
+def project_qkv(qkv_projection, qkv_sizes, queries, keys, values):
+    # self-attention: one GEMM over the shared input, then split into q, k, v
+    if queries is keys and keys is values:
+        return qkv_projection(queries).split(qkv_sizes, dim=-1)
+    weights = qkv_projection.weight.split(qkv_sizes, dim=0)
+    biases = qkv_projection.bias.split(qkv_sizes, dim=0)
+    return [F.linear(x, w, b) for x, w, b in zip((queries, keys, values), weights, biases)]
 
 class MultiScalePeriodicPatchEmbedding(nn.Module):
     def __init__(self, seq_len, num_features, top_k=5, d_model=512, dropout=0., adaptive=True, use_periodicity=True):
         super(MultiScalePeriodicPatchEmbedding, self).__init__()
         self.seq_len = seq_len
         self.top_k = top_k
+        self.d_model = d_model
         # get the patch sizes
-        self.patch_sizes = self.get_patch_sizes(seq_len)
+        self.patch_sizes = get_patch_sizes(seq_len)
+        print(self.patch_sizes)
         # AFNO1D parameters
         self.start_fc = nn.Linear(num_features, 1)
         self.num_freqs = seq_len // 2
       
         self.scale = 1 / d_model
-        self.w1 = nn.Parameter(self.scale * torch.randn(2, self.num_freqs, self.num_freqs * 4))
-        self.b1 = nn.Parameter(self.scale * torch.randn(2, self.num_freqs * 4))
-        self.w2 = nn.Parameter(self.scale * torch.randn(2, self.num_freqs * 4, self.num_freqs))
-        self.b2 = nn.Parameter(self.scale * torch.randn(2, self.num_freqs))
+        # real and imaginary parts on a trailing axis: real parameters (GradScaler can't unscale complex grads),
+        # used as complex through a free view_as_complex in forward
+        self.w1 = nn.Parameter(self.scale * torch.randn(self.num_freqs, self.num_freqs * 4, 2))
+        self.b1 = nn.Parameter(self.scale * torch.randn(self.num_freqs * 4, 2))
+        self.w2 = nn.Parameter(self.scale * torch.randn(self.num_freqs * 4, self.num_freqs, 2))
+        self.b2 = nn.Parameter(self.scale * torch.randn(self.num_freqs, 2))
         # Noise parameters
         self.w_gate = nn.Parameter(torch.zeros(self.num_freqs, len(self.patch_sizes)))
         self.w_noise = nn.Parameter(torch.zeros(self.num_freqs, len(self.patch_sizes)))
         # Patch Embedding parameters
+        self.num_patches = tuple(ceil(seq_len / patch_size) for patch_size in self.patch_sizes)
         self.value_embeddings = nn.ModuleList()
-        self.padding_patch_layers = nn.ModuleList()
-        for patch_size in self.patch_sizes:
+        self.pad_amounts = []
+        for patch_size, num_patches in zip(self.patch_sizes, self.num_patches):
             self.value_embeddings.append(nn.Linear(patch_size, d_model, bias=False))
-            self.padding_patch_layers.append(nn.ReplicationPad1d((0, ceil(seq_len / patch_size) * patch_size - seq_len)))
+            self.pad_amounts.append(num_patches * patch_size - seq_len)
         self.position_embedding = PositionalEmbedding2D(d_model, num_features, 512)
         # self.position_embedding = PositionalEmbedding(d_model, 512)
-        self.dropout = nn.Dropout(dropout)
+        # the embedding sum is a fresh tensor, so dropout can overwrite it
+        self.dropout = nn.Dropout(dropout, inplace=True)
         self.adaptive = adaptive
         self.use_periodicity = use_periodicity
     
-    def get_patch_sizes(self, seq_len):
-        # get the period list, first element is inf if exclude_zero is False
-        peroid_list = 1 / torch.fft.rfftfreq(seq_len)[1:]
-        patch_sizes = peroid_list.floor().int().unique().detach().cpu().numpy()[::-1]
-        # patch_sizes = peroid_list.ceil().int().unique().detach().cpu().numpy()[::-1]
-        print(patch_sizes)
-        return patch_sizes
-    
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # older checkpoints store the AFNO1D weights with the real/imaginary axis first, [2, ...]
+        for name in ('w1', 'b1', 'w2', 'b2'):
+            key = prefix + name
+            if key in state_dict and state_dict[key].shape != getattr(self, name).shape:
+                state_dict[key] = state_dict[key].movedim(0, -1)
+        super(MultiScalePeriodicPatchEmbedding, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def afno1d_for_peroid_weights(self, x, training, noise_epsilon=1e-2):
         # x [B, L, C]
         B, L, C = x.shape
 
-        x = self.start_fc(x).squeeze(-1) # [B, L]
+        # keep the spectrum in fp32 under autocast, half precision rfft only supports power-of-two lengths
+        x = self.start_fc(x).squeeze(-1).float() # [B, L]
         
         xf = torch.fft.rfft(x, dim=-1, norm='ortho') # [B, L//2+1]
         xf_ac = xf[:, 1:] # [B, L//2]
 
-        o1_real = F.relu(xf_ac.real @ self.w1[0] - xf_ac.imag @ self.w1[1] + self.b1[0])
-        o1_imag = F.relu(xf_ac.imag @ self.w1[0] + xf_ac.real @ self.w1[1] + self.b1[1])
-        o2_real = o1_real @ self.w2[0] - o1_imag @ self.w2[1] + self.b2[0]
-        o2_imag = o1_imag @ self.w2[0] + o1_real @ self.w2[1] + self.b2[1]
+        # complex MLP as two complex GEMMs, ReLU is applied to real and imaginary parts separately
+        o1 = xf_ac @ torch.view_as_complex(self.w1) + torch.view_as_complex(self.b1)
+        o1 = torch.complex(F.relu(o1.real), F.relu(o1.imag))
+        o2 = o1 @ torch.view_as_complex(self.w2) + torch.view_as_complex(self.b2)
 
-        xf_ac = torch.stack([o2_real, o2_imag], dim=-1) # [B, L-1, 2]
-        xf_ac = F.softshrink(xf_ac, lambd=0.01) # [B, L-1, 2]
+        xf_ac = F.softshrink(torch.view_as_real(o2), lambd=0.01) # [B, L-1, 2]
         xf_ac = torch.view_as_complex(xf_ac) # [B, L-1]
         xf_ac = torch.abs(xf_ac) # [B, L-1]
 
-        clean_logits = xf_ac @ self.w_gate
-        if training:
-            raw_noise_stddev = xf_ac @ self.w_noise
-            noise_stddev = (F.softplus(raw_noise_stddev) + noise_epsilon)
-            noise = torch.randn_like(clean_logits) * noise_stddev
-            noisy_logits = clean_logits + noise
-            logits = noisy_logits # [B, L-1]
-        else:
-            logits = clean_logits # [B, L-1]
-
-        weights = logits # B, L-1
-
-        top_weights, top_indices = torch.topk(weights, self.top_k, dim=-1) # [B, top_k]
-        top_weights = F.softmax(top_weights, dim=-1) # [B, top_k]
-        zeros = torch.zeros_like(weights) # [B, Ps]
-        gates = zeros.scatter_(-1, top_indices, top_weights) # [B, Ps]
-
-        return gates # [B, Ps]
+        # gate logits and weights stay in fp32 under autocast, otherwise the fp16 logits and the
+        # fp32 softmax output disagree in the scatter below
+        with torch.autocast(device_type=xf_ac.device.type, enabled=False):
+            clean_logits = xf_ac @ self.w_gate.float()
+            if training:
+                noise_stddev = F.softplus(xf_ac @ self.w_noise.float()).add_(noise_epsilon)
+                # clean_logits + noise * noise_stddev in a single fused op
+                logits = torch.addcmul(clean_logits, torch.randn_like(clean_logits), noise_stddev) # [B, L-1]
+            else:
+                logits = clean_logits # [B, L-1]
+
+            weights = logits # B, L-1
+
+            top_weights, top_indices = torch.topk(weights, self.top_k, dim=-1) # [B, top_k]
+            top_weights = F.softmax(top_weights, dim=-1) # [B, top_k]
+            zeros = torch.zeros_like(weights) # [B, Ps]
+            gates = zeros.scatter_(-1, top_indices, top_weights) # [B, Ps]
+
+        return gates, top_indices # [B, Ps], [B, top_k]
     
     def patch_embedding(self, x, patch_size, index_of_patch):
-        B, L, C = x.shape
-        # do patching
-        x = rearrange(x, 'B L C -> B C L') # [B, C, L]
-        x = self.padding_patch_layers[index_of_patch](x)
+        B, C, L = x.shape
+        # do patching, aligned patch sizes unfold the contiguous input without a padded copy
+        if self.pad_amounts[index_of_patch]:
+            x = F.pad(x, (0, self.pad_amounts[index_of_patch]), mode='replicate')
         x = x.unfold(-1, patch_size, patch_size) # [B, C, L//patch_size, patch_size]
-        x = self.value_embeddings[index_of_patch](x) + self.position_embedding(x) 
+        x = self.value_embeddings[index_of_patch](x).add_(self.position_embedding(x))
         return self.dropout(x) # [B, C, L, D]
 
     def forward(self, x):
-        gates = self.afno1d_for_peroid_weights(x, self.training) # [B, Ps]
-        xs = dispatch(x, gates)
+        gates, top_indices = self.afno1d_for_peroid_weights(x, self.training) # [B, Ps], [B, top_k]
+        dispatcher = SparseDispatcher(len(self.patch_sizes), gates, top_indices)
+        # transpose once before routing, every patch size then patches along a contiguous time axis
+        xs = dispatcher.dispatch(x.transpose(1, 2).contiguous()) # Ps*[B, C, L]
         _xs = []
         for i, patch_size in enumerate(self.patch_sizes):
+            B, C, L = xs[i].shape
+            # patch sizes not selected for any sample get an empty embedding without launching kernels
+            if B == 0:
+                _xs.append(xs[i].new_empty(0, C, self.num_patches[i], self.d_model))
+                continue
             _xs.append(self.patch_embedding(xs[i], patch_size, i))
-        return _xs, gates # Ps*[B, C, L, D], [bs, Ps]
+        return _xs, gates, dispatcher # Ps*[B, C, L, D], [bs, Ps]
     
 
 class MLP(nn.Module):
@@ -161,20 +198,21 @@ class CrossDimensionAttentionLayer(nn.Module):
         d_values = d_values or (d_model // n_heads)
 
         self.inner_attention = attention
-        self.query_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.key_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.value_projection = nn.Linear(d_model, d_values * n_heads)
+        self.qkv_projection = nn.Linear(d_model, (2 * d_keys + d_values) * n_heads)
         self.out_projection = nn.Linear(d_values * n_heads, d_model)
         self.n_heads = n_heads
+        self.qkv_sizes = [d_keys * n_heads, d_keys * n_heads, d_values * n_heads]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_qkv_state_dict(state_dict, prefix)
+        super(CrossDimensionAttentionLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, queries, keys, values, attn_mask, tau=None, delta=None):
         B, C, L, D = queries.shape
         _, _, S, _ = keys.shape
         H = self.n_heads
 
-        queries = self.query_projection(queries)
-        keys = self.key_projection(keys)
-        values = self.value_projection(values)
+        queries, keys, values = project_qkv(self.qkv_projection, self.qkv_sizes, queries, keys, values)
 
         # attention
         out, attn = self.inner_attention(
@@ -196,24 +234,25 @@ class InterPeriodicityAttentionLayer(nn.Module):
         d_values = d_values or (d_model // n_heads)
 
         self.inner_attention = attention
-        self.query_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.key_projection = nn.Linear(d_model, d_keys * n_heads)
-        self.value_projection = nn.Linear(d_model, d_values * n_heads)
+        self.qkv_projection = nn.Linear(d_model, (2 * d_keys + d_values) * n_heads)
         self.out_projection = nn.Linear(d_values * n_heads, d_model)
         self.n_heads = n_heads
+        self.qkv_sizes = [d_keys * n_heads, d_keys * n_heads, d_values * n_heads]
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        fuse_qkv_state_dict(state_dict, prefix)
+        super(InterPeriodicityAttentionLayer, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, queries, keys, values, attn_mask, tau=None, delta=None):
         B, C, L, D = queries.shape
         _, _, S, _ = keys.shape
         H = self.n_heads
 
-        queries = self.query_projection(queries)
-        keys = self.key_projection(keys)
-        values = self.value_projection(values)
+        queries, keys, values = project_qkv(self.qkv_projection, self.qkv_sizes, queries, keys, values)
 
-        queries = rearrange(queries, 'B C L D -> B L C D')
-        keys = rearrange(keys, 'B C S D -> B S C D')
-        values = rearrange(values, 'B C S D -> B S C D')
+        queries = queries.transpose(1, 2) # [B, L, C, D]
+        keys = keys.transpose(1, 2) # [B, S, C, D]
+        values = values.transpose(1, 2) # [B, S, C, D]
 
         # attention
         out, attn = self.inner_attention(
@@ -225,7 +264,7 @@ class InterPeriodicityAttentionLayer(nn.Module):
             delta=delta
         )
 
-        out = rearrange(out, 'B L C D -> B C L D')
+        out = out.transpose(1, 2) # [B, C, L, D]
 
         return self.out_projection(out), attn
 
@@ -301,12 +340,12 @@ class LinearPredictionHead(nn.Module):
         for patch_size in patch_sizes:
             self.linears.append(nn.Linear(d_model, pred_len))
         
-    def forward(self, xs, gates):
+    def forward(self, xs, dispatcher):
         # Ps*[B, C, L, D]
         for i, patch_size in enumerate(self.patch_sizes):
             xs[i] = self.linears[i](self.dropout(xs[i][:, :, -1:, :])) # [B, C, L, D] -> [B, C, P]
-        xs = combine(xs, gates)
-        xs = rearrange(xs.squeeze(-2), 'B C P -> B P C') # [B, P, C]
+        xs = dispatcher.combine(xs)
+        xs = xs.squeeze(-2).transpose(1, 2) # [B, P, C]
         return xs # [bs, P, C]
     
 
@@ -318,14 +357,14 @@ class LinearPredictionHead2(nn.Module):
         self.dropout = nn.Dropout(dropout)
         self.linear = nn.Linear(d_model, pred_len)
         
-    def forward(self, xs, gates):
+    def forward(self, xs, dispatcher):
         # Ps*[B, C, L, D]
         _xs = []
         for i, patch_size in enumerate(self.patch_sizes):
             _xs.append(xs[i][:, :, -1:, :])
-        _xs = combine(_xs, gates)
+        _xs = dispatcher.combine(_xs)
         _xs = self.linear(self.dropout(_xs.flatten(-2)))
-        _xs = rearrange(_xs, 'B C P -> B P C')
+        _xs = _xs.transpose(1, 2) # [B, P, C]
         return _xs
 
 
@@ -337,7 +376,10 @@ class Model(nn.Module):
         self.label_len = configs.label_len
         self.pred_len = configs.pred_len
         self.individual = configs.individual
-
+        # TF32 tensor cores for matmuls/convs on Ampere and newer GPUs;
+        # note these flags are process-wide, so everything else run in this process gets TF32 too
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
 
         self.msppe = MultiScalePeriodicPatchEmbedding(self.seq_len, configs.enc_in, configs.top_k, d_model=configs.d_model, dropout=configs.dropout)
         self.patch_sizes = self.msppe.patch_sizes
@@ -367,6 +409,13 @@ class Model(nn.Module):
 
         self.head = LinearPredictionHead2(self.patch_sizes, self.seq_len, self.pred_len, configs.d_model, dropout=configs.dropout)
 
+        if configs.use_compile:
+            # the routing needs python split sizes, so compile the per-patch-size encoders where the heavy work is;
+            # each one sees a data-dependent batch size, hence dynamic shapes, and no CUDA graphs since those
+            # re-record (and keep a memory pool) for every distinct batch size
+            for encoder in self.encoders:
+                encoder.compile(mode='max-autotune-no-cudagraphs', dynamic=True)
+
 
 
     def forward(self, x_enc, x_mark_enc, x_dec, x_mark_dec):
@@ -378,18 +427,22 @@ class Model(nn.Module):
 
 
         # Multi-scale periodic patch embedding 
-        xs_enc, gates_enc = self.msppe(x_enc) # Ps*[B, C, L, D], [B, Ps]
+        xs_enc, gates_enc, dispatcher = self.msppe(x_enc) # Ps*[B, C, L, D], [B, Ps]
         # Encoder and Decoder
         enc_outs = []
         for i, x_enc in enumerate(xs_enc):
+            # patch sizes not selected for any sample keep their empty input
+            if x_enc.size(0) == 0:
+                enc_outs.append(x_enc)
+                continue
             enc_out, attns = self.encoders[i](x_enc) # [B, C, VT, D]
             enc_outs.append(enc_out)
 
         # Head
-        dec_out = self.head(enc_outs, gates_enc)
+        dec_out = self.head(enc_outs, dispatcher)
 
         # De-Normalization from Non-stationary Transformer
-        dec_out = dec_out * (stdev[:, 0, :].unsqueeze(1).repeat(1, self.pred_len, 1))
-        dec_out = dec_out + (means[:, 0, :].unsqueeze(1).repeat(1, self.pred_len, 1))
+        dec_out = dec_out * stdev[:, :1, :] # broadcast over pred_len
+        dec_out = dec_out + means[:, :1, :]
 
         return dec_out
@@ -78,6 +78,7 @@ if __name__ == '__main__':
     parser.add_argument('--loss', type=str, default='MHWMSE', help='loss function')
     parser.add_argument('--lradj', type=str, default='OneCycleLR', help='adjust learning rate')
     parser.add_argument('--use_amp', action='store_true', help='use automatic mixed precision training', default=False)
+    parser.add_argument('--use_compile', action='store_true', help='compile the MSPT encoders with torch.compile', default=False)
 
     # GPU
     parser.add_argument('--use_gpu', type=bool, default=True, help='use gpu')